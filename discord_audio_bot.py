@@ -6,25 +6,38 @@ Plays YouTube audio and speaks via ElevenLabs TTS with professional audio mixing
 """
 
 import asyncio
+import collections
+import functools
+import hashlib
 import json
 import logging
 import os
 import subprocess
 import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Optional, Dict
 import signal
 import threading
+import time
 import numpy as np
+import orjson
 import sounddevice as sd
 import yt_dlp
 from dotenv import load_dotenv
+import aiohttp
+import av
 import discord
 from discord import app_commands
 from discord.ext import commands
-import requests
 from io import BytesIO
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional - the NumPy mixer is used instead
+    njit = None
+
 # Load .env
 load_dotenv()
 
@@ -34,6 +47,10 @@ ELEVENLABS_API_KEY = os.getenv("ELEVENLABS_API_KEY")
 ELEVENLABS_VOICE_ID = os.getenv("ELEVENLABS_VOICE_ID", "21m00Tcm4TlvDq8ikWAM")  # Default: Rachel voice
 AUTHORIZED_USER = "kael558"  # Only this user can restart the bot
 PLAYLIST_FILE = Path("playlist.json")
+DEVICE_FILE = Path("selected_device.json")
+SAVE_DEBOUNCE = 0.5  # Seconds to coalesce queue changes before writing playlist.json
+TTS_CACHE_DIR = Path("tts_cache")
+TTS_CACHE_MAX_BYTES = 100 * 1024 * 1024  # ~18 minutes of cached 48 kHz mono speech
 LOG_DIR = Path("logs")
 
 # Setup logging
@@ -51,30 +68,59 @@ logger = logging.getLogger("discord_audio_bot")
 # Bot setup
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix="!", intents=intents)
+# Every command is a slash command; a mention-only prefix keeps ordinary "!" chat
+# messages from being parsed and dispatched to on_command_error as CommandNotFound
+bot = commands.Bot(command_prefix=commands.when_mentioned, intents=intents, case_insensitive=True)
 
 # Audio configuration
 SAMPLE_RATE = 48000
 CHANNELS = 2
 BLOCKSIZE = 4096
+SAMPLE_WIDTH = 2  # Bytes per sample - PCM is carried as s16le end to end
+PCM_SCALE = np.float32(1.0 / 32768)  # int16 -> float32 at the mixer boundary
+ACTIVE_LEVEL = 0.001 / PCM_SCALE  # int16 level above which TTS counts as speaking
+MIX_LIMIT = np.float32(0.95)  # Limiter ceiling for the final mix
 
 # Global state
 state = {
     "paused": False,
     "volume": 1.0,
     "skip": False,
-    "queue": asyncio.Queue(),
+    "resume_event": threading.Event(),  # Wakes a paused producer on resume or skip
+    "queue_items": collections.deque(),  # Pending track URLs
+    "queue_event": asyncio.Event(),      # Set while queue_items is non-empty
+    "queue_display": "",                 # Numbered listing of queue_items for /queue
     "current_track": None,
     "playback_task": None,
-    "music_task": None,
-    "yt_task": None,
+    "save_task": None,
+    "save_event": asyncio.Event(),  # Set when the queue has unsaved changes
+    "prefetch": None,      # (page URL, task resolving its stream URL) for the next track
     "audio_stream": None,
     "music_buffer": None,  # Ring buffer for music
     "tts_buffer": None,    # Ring buffer for TTS
+    "tts_scratch": None,   # Reusable TTS block for the audio callback
     "buffer_lock": threading.Lock(),
     "audio_device_id": None,  # Selected audio device
+    "http": None,             # Keep-alive aiohttp session for ElevenLabs
 }
 
+# PortAudio device list, refreshed at most once per DEVICE_CACHE_TTL
+DEVICE_CACHE_TTL = 5.0
+_device_cache = {"ts": 0.0, "devices": None}
+
+
+# ============================
+# Device Config
+# ============================
+
+@functools.lru_cache(maxsize=1)
+def _load_device_config(path: Path = DEVICE_FILE) -> Dict:
+    """Read selected_device.json once per process (cleared by /setdevice)"""
+    try:
+        return orjson.loads(path.read_bytes())
+    except FileNotFoundError:
+        return {}
+
 
 # ============================
 # Queue Persistence
@@ -82,132 +128,358 @@ state = {
 
 def load_queue():
     """Load queue from disk"""
-    if PLAYLIST_FILE.exists():
-        try:
-            with open(PLAYLIST_FILE, 'r') as f:
-                data = json.load(f)
-                return data.get("queue", [])
-        except Exception as e:
-            logger.error(f"Failed to load queue: {e}")
+    try:
+        data = orjson.loads(PLAYLIST_FILE.read_bytes())
+        return data.get("queue", [])
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Failed to load queue: {e}")
     return []
 
 
-def save_queue():
-    """Save queue to disk"""
+def save_queue(items=None):
+    """Save queue to disk atomically (items defaults to a snapshot of the current queue)"""
     try:
-        items = list(state["queue"]._queue)
-        with open(PLAYLIST_FILE, 'w') as f:
-            json.dump({"queue": items}, f, indent=2)
+        if items is None:
+            items = list(state["queue_items"])
+        tmp_file = PLAYLIST_FILE.with_suffix(".json.tmp")
+        tmp_file.write_bytes(orjson.dumps({"queue": items}, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_file, PLAYLIST_FILE)
     except Exception as e:
         logger.error(f"Failed to save queue: {e}")
 
 
+def request_save():
+    """Mark the queue dirty - queue_saver writes it out shortly after"""
+    state["save_event"].set()
+
+
+async def queue_saver():
+    """Coalesce queue changes into at most one disk write per SAVE_DEBOUNCE"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await state["save_event"].wait()
+        await asyncio.sleep(SAVE_DEBOUNCE)
+        state["save_event"].clear()
+
+        # Snapshot on the event loop, write from the executor
+        await loop.run_in_executor(None, save_queue, list(state["queue_items"]))
+
+
+def refresh_queue_display():
+    """Rebuild the /queue listing - call after every queue mutation"""
+    state["queue_display"] = "\n".join(f"{i}. {url}" for i, url in enumerate(state["queue_items"], 1))
+
+
+def enqueue(*urls: str):
+    """Append track URLs to the queue and wake the playback loop"""
+    state["queue_items"].extend(urls)
+    refresh_queue_display()
+    if state["queue_items"]:
+        state["queue_event"].set()
+
+
+async def dequeue() -> str:
+    """Wait for and pop the next track URL from the queue"""
+    while not state["queue_items"]:
+        state["queue_event"].clear()
+        await state["queue_event"].wait()
+    url = state["queue_items"].popleft()
+    refresh_queue_display()
+    return url
+
+
 # ============================
 # Audio Mixer (sounddevice-based)
 # ============================
 
 class AudioBuffer:
-    """Thread-safe queue-based audio buffer"""
-    def __init__(self, maxsize=SAMPLE_RATE * 10):  # 10 seconds buffer
-        self.buffer = []
+    """Thread-safe ring buffer of int16 PCM backed by a preallocated numpy array"""
+    def __init__(self, maxsize=SAMPLE_RATE * 10, high_water=SAMPLE_RATE * 2, track_activity=False):  # 10 seconds buffer, 2 seconds queued
+        self.data = np.zeros((maxsize, CHANNELS), dtype=np.int16)
         self.lock = threading.Lock()
         self.maxsize = maxsize
-        self.current_size = 0
+        self.read_idx = 0
+        self.write_idx = 0
+        self.count = 0
+
+        # Signal detection happens on the writer side: active_frames counts the
+        # frames from the read position to the end of the last non-silent chunk
+        self.track_activity = track_activity
+        self.active_frames = 0
+
+        # Producer backpressure: the reader wakes a waiting producer once the
+        # buffer drains to high_water
+        self.high_water = high_water
+        self.space_event = asyncio.Event()    # For producers on the event loop
+        self.space_loop = None
+        self.space_ready = threading.Event()  # For producers on AUDIO_EXECUTOR
+        self.space_waiting = False
 
     def write(self, data: np.ndarray):
-        """Write audio data to buffer"""
+        """Write audio data to buffer - mono (frames,) input is duplicated across channels"""
+        if data.ndim == 1:
+            # Broadcast view; copyto expands it into every channel without a temporary
+            data = data[:, np.newaxis]
+
+        # min/max reductions scan the chunk without allocating a temporary
+        chunk_active = (
+            self.track_activity and len(data) > 0
+            and (data.max() > ACTIVE_LEVEL or data.min() < -ACTIVE_LEVEL)
+        )
+
         with self.lock:
             data_len = len(data)
             if data_len == 0:
                 return
 
+            # Keep only the newest frames if the chunk alone exceeds capacity
+            if data_len > self.maxsize:
+                data = data[-self.maxsize:]
+                data_len = self.maxsize
+
             # Check if buffer is getting too full
-            if self.current_size + data_len > self.maxsize:
-                # Drop oldest chunks until there's room
-                while self.buffer and self.current_size + data_len > self.maxsize:
-                    oldest = self.buffer.pop(0)
-                    self.current_size -= len(oldest)
-                logger.warning(f"Audio buffer overflow, dropped {data_len} frames")
-
-            # Add new data
-            self.buffer.append(data.copy())
-            self.current_size += data_len
-
-    def read(self, frames: int) -> np.ndarray:
-        """Read audio data from buffer, return silence if empty"""
+            overflow = self.count + data_len - self.maxsize
+            if overflow > 0:
+                # Drop oldest frames to make room
+                self.read_idx = (self.read_idx + overflow) % self.maxsize
+                self.count -= overflow
+                self.active_frames = max(0, self.active_frames - overflow)
+                logger.warning(f"Audio buffer overflow, dropped {overflow} frames")
+
+            # Copy in at most two contiguous slices (wraparound)
+            w = self.write_idx
+            n1 = min(data_len, self.maxsize - w)
+            np.copyto(self.data[w:w + n1], data[:n1])
+            if n1 < data_len:
+                np.copyto(self.data[:data_len - n1], data[n1:])
+
+            self.write_idx = (w + data_len) % self.maxsize
+            self.count += data_len
+            if chunk_active:
+                self.active_frames = self.count
+
+    def read_into(self, out: np.ndarray, frames: int) -> int:
+        """
+        Read audio data into the float32 array out[:frames], zero-filling any shortfall
+        Returns the number of frames read
+        """
         with self.lock:
-            if not self.buffer or self.current_size == 0:
-                return np.zeros((frames, CHANNELS), dtype=np.float32)
-
-            result = np.zeros((frames, CHANNELS), dtype=np.float32)
-            read_offset = 0
-
-            while read_offset < frames and self.buffer:
-                chunk = self.buffer[0]
-                chunk_len = len(chunk)
-                remaining = frames - read_offset
-
-                if chunk_len <= remaining:
-                    # Use entire chunk
-                    result[read_offset:read_offset + chunk_len] = chunk
-                    read_offset += chunk_len
-                    self.buffer.pop(0)
-                    self.current_size -= chunk_len
-                else:
-                    # Use part of chunk
-                    result[read_offset:read_offset + remaining] = chunk[:remaining]
-                    self.buffer[0] = chunk[remaining:]
-                    self.current_size -= remaining
-                    read_offset += remaining
+            n = min(frames, self.count)
+            if n:
+                # Convert out at most two contiguous slices (wraparound)
+                r = self.read_idx
+                n1 = min(n, self.maxsize - r)
+                np.multiply(self.data[r:r + n1], PCM_SCALE, out=out[:n1])
+                if n1 < n:
+                    np.multiply(self.data[:n - n1], PCM_SCALE, out=out[n1:n])
+
+                self.consume(n)
+
+        if n < frames:
+            out[n:frames] = 0
+        return n
+
+    def consume(self, frames: int):
+        """Advance the read position by frames (caller must hold self.lock)"""
+        self.read_idx = (self.read_idx + frames) % self.maxsize
+        self.count -= frames
+        self.active_frames = max(0, self.active_frames - frames)
+        if self.space_waiting and self.count <= self.high_water:
+            self._notify_space()
+
+    def _notify_space(self):
+        """Wake the producer waiting in wait_for_space (caller must hold self.lock)"""
+        self.space_waiting = False
+        self.space_ready.set()
+        if self.space_loop is not None:
+            try:
+                self.space_loop.call_soon_threadsafe(self.space_event.set)
+            except RuntimeError:
+                # Event loop already closed during shutdown
+                pass
 
-            return result
+    async def wait_for_space(self):
+        """Wait until the buffer has drained to its high-water mark"""
+        while True:
+            with self.lock:
+                if self.count <= self.high_water:
+                    return
+                self.space_loop = asyncio.get_running_loop()
+                self.space_event.clear()
+                self.space_waiting = True
+            await self.space_event.wait()
+
+    def wait_for_space_blocking(self):
+        """Block the calling thread until the buffer has drained to its high-water mark"""
+        while True:
+            with self.lock:
+                if self.count <= self.high_water:
+                    return
+                self.space_ready.clear()
+                self.space_waiting = True
+            self.space_ready.wait()
 
     def clear(self):
-        """Clear the buffer"""
+        """Clear the buffer, waking any producer waiting for space"""
         with self.lock:
-            self.buffer.clear()
-            self.current_size = 0
+            self.read_idx = 0
+            self.write_idx = 0
+            self.count = 0
+            self.active_frames = 0
+            if self.space_waiting:
+                self._notify_space()
+
+    def is_active(self) -> bool:
+        """Whether non-silent audio is queued (requires track_activity)"""
+        return self.active_frames > 0
 
     def available_frames(self):
         """Get number of frames available in buffer"""
         with self.lock:
-            return self.current_size
+            return self.count
+
+
+def raise_thread_priority():
+    """Raise the calling thread's scheduling priority where the OS allows it"""
+    try:
+        # Linux applies this to the calling thread only
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))
+        logger.info("Audio producer thread running with SCHED_FIFO")
+        return
+    except (AttributeError, OSError):
+        pass
+
+    try:
+        os.nice(-5)
+        logger.info("Audio producer thread running at nice -5")
+    except (AttributeError, OSError):
+        logger.info("Audio producer thread running at normal priority (needs CAP_SYS_NICE to raise)")
+
+
+# Single thread that feeds decoded music into the ring buffer, so the feed
+# doesn't queue behind Discord traffic on the event loop
+AUDIO_EXECUTOR = ThreadPoolExecutor(
+    max_workers=1,
+    thread_name_prefix="audio-producer",
+    initializer=raise_thread_priority
+)
+
+
+def _mix_frames(out, music, m_read, m_count, tts, t_read, t_count, tts_active, volume, frames):
+    """
+    Mix frames from the int16 music and TTS rings into the float32 out in a single pass
+    Returns the number of frames consumed from each ring
+    """
+    channels = out.shape[1]
+    m_size = music.shape[0]
+    t_size = tts.shape[0]
+    m_n = min(frames, m_count)
+    t_n = min(frames, t_count)
+
+    # Simple ducking: reduce music volume when TTS is playing
+    gain = volume * 0.2 if tts_active else volume
+    gain *= PCM_SCALE
+
+    # Scale music, add TTS and apply limiter
+    mi = m_read
+    ti = t_read
+    for i in range(frames):
+        for c in range(channels):
+            v = 0.0
+            if i < m_n:
+                v = music[mi, c] * gain
+            if i < t_n:
+                v += tts[ti, c] * PCM_SCALE
+            out[i, c] = min(max(v, -MIX_LIMIT), MIX_LIMIT)
+        mi += 1
+        if mi == m_size:
+            mi = 0
+        ti += 1
+        if ti == t_size:
+            ti = 0
+
+    return m_n, t_n
+
+
+# Compiled mixer that runs without the GIL, or None to use the NumPy path
+_mix_kernel = njit(nogil=True, fastmath=True, cache=True)(_mix_frames) if njit else None
 
 
 def audio_callback(outdata, frames, time_info, status):
-    """Audio callback for sounddevice - mixes music and TTS"""
+    """Audio callback for sounddevice - mixes music and TTS in place"""
     if status:
         logger.warning(f"Audio callback status: {status}")
 
-    # Read from buffers
-    music = state["music_buffer"].read(frames) if state["music_buffer"] else np.zeros((frames, CHANNELS), dtype=np.float32)
-    tts = state["tts_buffer"].read(frames) if state["tts_buffer"] else np.zeros((frames, CHANNELS), dtype=np.float32)
+    music_buffer = state["music_buffer"]
+    tts_buffer = state["tts_buffer"]
+    if not music_buffer or not tts_buffer:
+        outdata.fill(0)
+        return
 
-    # Apply volume to music
-    music *= state["volume"]
+    if _mix_kernel is not None:
+        with music_buffer.lock, tts_buffer.lock:
+            m_n, t_n = _mix_kernel(
+                outdata,
+                music_buffer.data, music_buffer.read_idx, music_buffer.count,
+                tts_buffer.data, tts_buffer.read_idx, tts_buffer.count,
+                tts_buffer.is_active(), state["volume"], frames
+            )
+            music_buffer.consume(m_n)
+            tts_buffer.consume(t_n)
+        return
+
+    # Music goes straight into the output buffer
+    music_buffer.read_into(outdata, frames)
+
+    # TTS goes into a scratch buffer allocated once by start_audio_system
+    tts = state["tts_scratch"]
+    if tts is None or len(tts) < frames:
+        tts = state["tts_scratch"] = np.zeros((frames, CHANNELS), dtype=np.float32)
+    tts = tts[:frames]
+    tts_active = tts_buffer.is_active()  # Checked before the read consumes the frames
+    tts_buffer.read_into(tts, frames)
 
     # Simple ducking: reduce music volume when TTS is playing
-    tts_active = np.any(np.abs(tts) > 0.001)
-    if tts_active:
-        music *= 0.2  # Duck music to 20% when TTS is playing
+    gain = state["volume"] * (0.2 if tts_active else 1.0)  # Duck music to 20% when TTS is playing
 
-    # Mix and apply limiter
-    mixed = music + tts
-    mixed = np.clip(mixed, -0.95, 0.95)
+    # Scale music once by the combined gain, mix and apply limiter
+    np.multiply(outdata, gain, out=outdata)
+    np.add(outdata, tts, out=outdata)
+    np.minimum(outdata, MIX_LIMIT, out=outdata)
+    np.maximum(outdata, -MIX_LIMIT, out=outdata)
 
-    outdata[:] = mixed
+
+def cached_query_devices(ttl: float = DEVICE_CACHE_TTL):
+    """Return sd.query_devices(), reusing the last result for ttl seconds"""
+    now = time.monotonic()
+    if _device_cache["devices"] is None or now - _device_cache["ts"] > ttl:
+        _device_cache["devices"] = sd.query_devices()
+        _device_cache["ts"] = now
+    return _device_cache["devices"]
 
 
 def start_audio_system():
     """Start the sounddevice audio output system"""
     try:
-        # Initialize buffers
-        state["music_buffer"] = AudioBuffer()
-        state["tts_buffer"] = AudioBuffer()
+        # Create the buffers once - a running decoder or /say keeps writing to the
+        # same objects when /setdevice restarts the stream
+        if state["music_buffer"] is None:
+            state["music_buffer"] = AudioBuffer()
+            state["tts_buffer"] = AudioBuffer(track_activity=True)
+            state["tts_scratch"] = np.zeros((BLOCKSIZE, CHANNELS), dtype=np.float32)
+
+        # Compile the mixer now so the first audio callback doesn't pay for it
+        if _mix_kernel is not None:
+            _mix_kernel(state["tts_scratch"], state["music_buffer"].data, 0, 0,
+                        state["tts_buffer"].data, 0, 0, False, 1.0, BLOCKSIZE)
+            logger.info("Using compiled audio mixer")
 
         # List available devices for debugging
         logger.info("Available audio devices:")
-        logger.info(sd.query_devices())
+        devices = cached_query_devices()
+        logger.info(devices)
 
         # Determine which device to use
         device_id = state["audio_device_id"]
@@ -227,7 +499,7 @@ def start_audio_system():
         )
         state["audio_stream"].start()
 
-        device_info = sd.query_devices(device_id if device_id is not None else sd.default.device[1])
+        device_info = devices[device_id if device_id is not None else sd.default.device[1]]
         logger.info(f"Audio system started on device: {device_info['name']} (sample_rate={SAMPLE_RATE}, channels={CHANNELS})")
         return True
 
@@ -243,6 +515,11 @@ def stop_audio_system():
             state["audio_stream"].stop()
             state["audio_stream"].close()
             state["audio_stream"] = None
+
+        # Nothing drains the buffers without a stream - release any waiting producer
+        for buffer in (state["music_buffer"], state["tts_buffer"]):
+            if buffer:
+                buffer.clear()
         logger.info("Audio system stopped")
     except Exception as e:
         logger.error(f"Error stopping audio system: {e}")
@@ -252,142 +529,131 @@ def stop_audio_system():
 # YouTube Playback
 # ============================
 
-async def play_youtube(url: str):
+def decode_stream(stream_url: str, buffer: AudioBuffer, stop: threading.Event, on_first_block) -> bool:
     """
-    Play YouTube audio by converting to PCM and streaming to music buffer
+    Decode a media URL in-process with PyAV and write s16 stereo PCM into buffer
+    until EOF, skip or stop. Runs on AUDIO_EXECUTOR; returns True if the track was skipped
     """
-    if not state["music_buffer"]:
-        logger.error("Music buffer not available")
-        return False
+    options = {"reconnect": "1", "reconnect_streamed": "1", "reconnect_delay_max": "5"}
+    with av.open(stream_url, options=options, timeout=(10.0, 30.0)) as container:
+        audio_stream = container.streams.audio[0]
+        if audio_stream.rate != SAMPLE_RATE:
+            logger.info(f"Resampling {audio_stream.rate} Hz source to {SAMPLE_RATE} Hz")
+        # Converts to packed s16 stereo, resampling only if the source isn't at SAMPLE_RATE
+        resampler = av.AudioResampler(format="s16", layout="stereo", rate=SAMPLE_RATE)
+        first_block = True
+
+        for frame in container.decode(audio_stream):
+            # Check for skip first (even during pause)
+            if state["skip"] or stop.is_set():
+                return state["skip"]
 
-    try:
-        # Start yt-dlp to download audio and pipe to FFmpeg for conversion
-        yt_process = await asyncio.create_subprocess_exec(
-            "yt-dlp", "-f", "bestaudio", "-o", "-", url,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+            # Check for pause (cleared before the check so a resume can't slip past)
+            state["resume_event"].clear()
+            while state["paused"] and not state["skip"] and not stop.is_set():
+                state["resume_event"].wait()
+                state["resume_event"].clear()
 
-        # Convert to raw PCM float32
-        ffmpeg_process = await asyncio.create_subprocess_exec(
-            "ffmpeg",
-            "-i", "pipe:0",
-            "-f", "f32le",
-            "-ar", str(SAMPLE_RATE),
-            "-ac", str(CHANNELS),
-            "pipe:1",
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
+            # Backpressure: wait if buffer is too full
+            buffer.wait_for_space_blocking()
 
-        # Store processes for skip/shutdown functionality
-        state["music_task"] = ffmpeg_process
-        state["yt_task"] = yt_process
+            # Packed s16 frames arrive as a (1, samples * channels) array
+            for out_frame in resampler.resample(frame):
+                buffer.write(out_frame.to_ndarray().reshape(-1, CHANNELS))
 
-        # Create task to pipe yt-dlp output to FFmpeg input
-        async def pipe_yt_to_ffmpeg():
-            try:
-                while True:
-                    chunk = await yt_process.stdout.read(65536)
-                    if not chunk:
-                        break
-                    ffmpeg_process.stdin.write(chunk)
-                    await ffmpeg_process.stdin.drain()
-            except (asyncio.CancelledError, BrokenPipeError, ConnectionResetError):
-                # Expected when track is skipped
-                pass
-            except Exception as e:
-                logger.error(f"Error piping yt-dlp to FFmpeg: {e}")
-            finally:
-                try:
-                    if ffmpeg_process.stdin and not ffmpeg_process.stdin.is_closing():
-                        ffmpeg_process.stdin.close()
-                except:
-                    pass
-
-        pipe_task = asyncio.create_task(pipe_yt_to_ffmpeg())
-
-        # Stream PCM to music buffer
-        while True:
-            # Check for skip first (even during pause)
-            if state["skip"]:
-                state["skip"] = False
-                # Cancel pipe task first
-                pipe_task.cancel()
-                try:
-                    await asyncio.wait_for(pipe_task, timeout=0.5)
-                except (asyncio.CancelledError, asyncio.TimeoutError):
-                    pass
-                # Then terminate processes
-                try:
-                    ffmpeg_process.terminate()
-                    yt_process.terminate()
-                except:
-                    pass
-                # Clear the music buffer
-                if state["music_buffer"]:
-                    state["music_buffer"].clear()
-                logger.info("Track skipped")
-                break
-
-            # Check for pause
-            while state["paused"] and not state["skip"]:
-                await asyncio.sleep(0.1)
+            if first_block:
+                first_block = False
+                on_first_block()
 
-            # Backpressure: wait if buffer is too full
-            while state["music_buffer"] and state["music_buffer"].available_frames() > SAMPLE_RATE * 2:  # 2 seconds max buffer
-                await asyncio.sleep(0.1)
+        # Drain whatever the resampler is still holding
+        for out_frame in resampler.resample(None):
+            buffer.write(out_frame.to_ndarray().reshape(-1, CHANNELS))
 
-            # Read PCM chunk (4 bytes per sample for float32)
-            chunk = await ffmpeg_process.stdout.read(BLOCKSIZE * CHANNELS * 4)
+    return False
 
-            if not chunk:
-                break
 
-            # Convert bytes to numpy array
-            audio_data = np.frombuffer(chunk, dtype=np.float32).reshape(-1, CHANNELS)
+async def resolve_stream(url: str) -> Optional[Dict]:
+    """Resolve a YouTube page URL to the direct URL and format info of its best audio stream"""
+    video_info = await search_youtube(url)
+    if not video_info or not video_info['stream_url']:
+        logger.error(f"Could not resolve stream URL for {url}")
+        return None
+    return video_info
 
-            # Write to music buffer
-            state["music_buffer"].write(audio_data)
 
-        # Wait for pipe task to complete
-        try:
-            await asyncio.wait_for(pipe_task, timeout=1.0)
-        except (asyncio.CancelledError, asyncio.TimeoutError):
-            pass
+def prefetch_next():
+    """Start resolving the next queued track while the current one plays"""
+    if not state["queue_items"]:
+        return
+
+    next_url = state["queue_items"][0]
+    prefetch = state["prefetch"]
+    if prefetch and prefetch[0] == next_url:
+        return
+    if prefetch:
+        prefetch[1].cancel()
+
+    logger.info(f"Prefetching: {next_url}")
+    state["prefetch"] = (next_url, asyncio.create_task(resolve_stream(next_url)))
 
-        # Wait for processes to complete with timeout
+
+async def get_stream(url: str) -> Optional[Dict]:
+    """Return the resolved stream for url, using the prefetched result when it matches"""
+    prefetch = state["prefetch"]
+    state["prefetch"] = None
+
+    if prefetch and prefetch[0] == url:
         try:
-            await asyncio.wait_for(ffmpeg_process.wait(), timeout=2.0)
-        except asyncio.TimeoutError:
-            ffmpeg_process.kill()
+            stream = await prefetch[1]
+        except Exception as e:
+            logger.warning(f"Prefetch failed for {url}: {e}")
+            stream = None
+        if stream:
+            return stream
+    elif prefetch:
+        prefetch[1].cancel()
+
+    return await resolve_stream(url)
 
+
+async def play_youtube(url: str):
+    """
+    Play YouTube audio by converting to PCM and streaming to music buffer
+    """
+    if not state["music_buffer"]:
+        logger.error("Music buffer not available")
+        return False
+
+    try:
+        stream = await get_stream(url)
+        if not stream:
+            return False
+
+        # Decode on the producer thread. Once the track is streaming,
+        # resolve the next one in the background
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
         try:
-            await asyncio.wait_for(yt_process.wait(), timeout=2.0)
-        except asyncio.TimeoutError:
-            yt_process.kill()
+            skipped = await loop.run_in_executor(
+                AUDIO_EXECUTOR, decode_stream, stream['stream_url'], state["music_buffer"], stop,
+                lambda: loop.call_soon_threadsafe(prefetch_next)
+            )
+        except asyncio.CancelledError:
+            # Release the producer thread wherever it is waiting
+            stop.set()
+            state["resume_event"].set()
+            state["music_buffer"].clear()
+            raise
+
+        if skipped:
+            state["skip"] = False
+            # Clear the music buffer
+            if state["music_buffer"]:
+                state["music_buffer"].clear()
+            logger.info("Track skipped")
 
-        state["music_task"] = None
-        state["yt_task"] = None
         return True
 
-    except asyncio.CancelledError:
-        # Clean up processes on cancellation
-        if state["music_task"]:
-            state["music_task"].terminate()
-            try:
-                await asyncio.wait_for(state["music_task"].wait(), timeout=1.0)
-            except asyncio.TimeoutError:
-                state["music_task"].kill()
-
-        if state["yt_task"]:
-            state["yt_task"].terminate()
-            try:
-                await asyncio.wait_for(state["yt_task"].wait(), timeout=1.0)
-            except asyncio.TimeoutError:
-                state["yt_task"].kill()
-        raise
     except Exception as e:
         logger.error(f"Playback error: {e}", exc_info=True)
         return False
@@ -400,7 +666,7 @@ async def playback_loop():
     while True:
         try:
             # Get next track from queue
-            url = await state["queue"].get()
+            url = await dequeue()
             state["current_track"] = url
 
             logger.info(f"Now playing: {url}")
@@ -412,7 +678,7 @@ async def playback_loop():
                 logger.warning(f"Failed to play: {url}")
 
             state["current_track"] = None
-            save_queue()
+            request_save()
 
         except asyncio.CancelledError:
             logger.info("Playback loop stopped")
@@ -426,10 +692,50 @@ async def playback_loop():
 # ElevenLabs TTS
 # ============================
 
+def get_http_session() -> aiohttp.ClientSession:
+    """Return the shared ElevenLabs session, creating it on first use"""
+    if state["http"] is None or state["http"].closed:
+        state["http"] = aiohttp.ClientSession(headers={"xi-api-key": ELEVENLABS_API_KEY})
+    return state["http"]
+
+
+def tts_cache_key(params: Dict, data: Dict) -> str:
+    """Hash everything that affects the synthesized audio"""
+    payload = json.dumps({"voice_id": ELEVENLABS_VOICE_ID, "params": params, "data": data}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def prune_tts_cache():
+    """Evict least recently used cache files until the cache fits TTS_CACHE_MAX_BYTES"""
+    try:
+        files = sorted(
+            ((f.stat(), f) for f in TTS_CACHE_DIR.glob("*.pcm")),
+            key=lambda entry: entry[0].st_mtime,
+            reverse=True
+        )
+        total = 0
+        for stat, f in files:
+            total += stat.st_size
+            if total > TTS_CACHE_MAX_BYTES:
+                f.unlink(missing_ok=True)
+    except Exception as e:
+        logger.warning(f"Failed to prune TTS cache: {e}")
+
+
+async def play_cached_tts(path: Path):
+    """Stream cached mono PCM from disk into the TTS buffer"""
+    pcm = np.memmap(path, dtype=np.int16, mode="r")
+    for start in range(0, len(pcm), BLOCKSIZE):
+        # Backpressure: wait if buffer is too full
+        await state["tts_buffer"].wait_for_space()
+
+        state["tts_buffer"].write(pcm[start:start + BLOCKSIZE])
+
+
 async def speak_text(text: str):
     """
     Speak text via ElevenLabs and inject to TTS buffer
-    Converts WAV to PCM and streams to tts_buffer
+    Requests raw mono PCM at SAMPLE_RATE and streams it into tts_buffer as it downloads
     """
     logger.info(f"speak_text called with: {text[:50]}...")
 
@@ -446,15 +752,12 @@ async def speak_text(text: str):
         url = f"https://api.elevenlabs.io/v1/text-to-speech/{ELEVENLABS_VOICE_ID}"
         logger.info(f"Requesting TTS from ElevenLabs API...")
 
-        headers = {
-            "xi-api-key": ELEVENLABS_API_KEY,
-            "Content-Type": "application/json"
-        }
+        # Raw s16le mono at the mixer's rate - no decode or resample needed
+        params = {"output_format": f"pcm_{SAMPLE_RATE}"}
 
         data = {
             "text": text,
             "model_id": "eleven_multilingual_v2",
-            "output_format": "mp3_44100_128",
             "voice_settings": {
                 "use_speaker_boost": True,
                 "stability": 0.58,
@@ -463,51 +766,58 @@ async def speak_text(text: str):
             }
         }
 
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: requests.post(url, json=data, headers=headers, stream=True)
-        )
-        logger.info(f"ElevenLabs response status: {response.status_code}")
-        response.raise_for_status()
-
-        # Convert WAV to PCM using FFmpeg
-        logger.info("Converting audio to PCM...")
-        ffmpeg_process = await asyncio.create_subprocess_exec(
-            "ffmpeg",
-            "-i", "pipe:0",
-            "-f", "f32le",
-            "-ar", str(SAMPLE_RATE),
-            "-ac", str(CHANNELS),
-            "pipe:1",
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-
-        # Write WAV data to FFmpeg
-        wav_data = response.content
-        logger.info(f"Writing {len(wav_data)} bytes of WAV data to FFmpeg")
-        ffmpeg_process.stdin.write(wav_data)
-        ffmpeg_process.stdin.close()
-
-        # Stream PCM to TTS buffer
-        logger.info("Streaming PCM to TTS buffer...")
-        total_bytes = 0
-        while True:
-            chunk = await ffmpeg_process.stdout.read(BLOCKSIZE * CHANNELS * 4)
-            if not chunk:
-                break
-
-            # Convert bytes to numpy array
-            audio_data = np.frombuffer(chunk, dtype=np.float32).reshape(-1, CHANNELS)
-
-            # Write to TTS buffer
-            state["tts_buffer"].write(audio_data)
-            total_bytes += len(chunk)
-
-        await ffmpeg_process.wait()
-        logger.info(f"TTS complete: streamed {total_bytes} bytes")
+        # Repeat utterances are served from disk without touching the API
+        cache_path = TTS_CACHE_DIR / f"{tts_cache_key(params, data)}.pcm"
+        if cache_path.exists():
+            logger.info(f"TTS cache hit: {cache_path.name}")
+            os.utime(cache_path)  # Mark as recently used
+            await play_cached_tts(cache_path)
+            logger.info(f"Spoke (cached): {text[:50]}...")
+            return True
+
+        # Reuses the pooled TLS connection to api.elevenlabs.io across utterances
+        async with get_http_session().post(url, params=params, json=data) as response:
+            logger.info(f"ElevenLabs response status: {response.status}")
+            response.raise_for_status()
+
+            # Stream PCM to TTS buffer as it arrives from the network
+            logger.info("Streaming PCM to TTS buffer...")
+            total_bytes = 0
+            pending = b""
+            TTS_CACHE_DIR.mkdir(exist_ok=True)
+            tmp_fd, tmp_name = tempfile.mkstemp(dir=TTS_CACHE_DIR, suffix=".tmp")
+            tmp_path = Path(tmp_name)
+            try:
+                with open(tmp_fd, "wb") as cache_file:
+                    async for chunk in response.content.iter_chunked(BLOCKSIZE * SAMPLE_WIDTH):
+                        # Network chunks may split a sample; carry the odd byte over
+                        if pending:
+                            chunk = pending + chunk
+                        usable = len(chunk) - len(chunk) % SAMPLE_WIDTH
+                        pending = chunk[usable:]
+                        if not usable:
+                            continue
+
+                        # Convert bytes to numpy array (mono - the buffer expands it to stereo)
+                        audio_data = np.frombuffer(chunk, dtype=np.int16, count=usable // SAMPLE_WIDTH)
+
+                        # Write to TTS buffer, holding off long utterances that outrun playback
+                        await state["tts_buffer"].wait_for_space()
+                        state["tts_buffer"].write(audio_data)
+                        cache_file.write(chunk[:usable])
+                        total_bytes += usable
+            except BaseException:
+                tmp_path.unlink(missing_ok=True)
+                raise
+
+            logger.info(f"TTS complete: streamed {total_bytes} bytes")
+
+        # Publish the finished utterance to the cache atomically
+        if total_bytes:
+            os.replace(tmp_path, cache_path)
+            prune_tts_cache()
+        else:
+            tmp_path.unlink(missing_ok=True)
 
         logger.info(f"Spoke: {text[:50]}...")
         return True
@@ -525,7 +835,8 @@ async def search_youtube(query: str) -> Optional[Dict]:
     """Search YouTube and return video info"""
     try:
         ydl_opts = {
-            'format': 'bestaudio/best',
+            # Prefer streams already at the mixer's rate (YouTube's Opus formats are 48 kHz)
+            'format': f'bestaudio[asr={SAMPLE_RATE}]/bestaudio/best',
             'quiet': True,
             'no_warnings': True,
             'extract_flat': False,
@@ -552,6 +863,7 @@ async def search_youtube(query: str) -> Optional[Dict]:
                     'url': info.get('webpage_url', ''),
                     'duration': info.get('duration', 0),
                     'uploader': info.get('uploader', 'Unknown'),
+                    'stream_url': info.get('url', ''),  # Direct media URL for the selected format
                 }
 
         return await loop.run_in_executor(None, _search)
@@ -580,10 +892,12 @@ async def play(interaction: discord.Interaction, query: str):
             return
 
         # Add URL to queue
-        await state["queue"].put(video_info['url'])
-        save_queue()
+        enqueue(video_info['url'])
+        request_save()
+        if state["current_track"]:
+            prefetch_next()
 
-        position = state["queue"].qsize()
+        position = len(state["queue_items"])
         duration_min = video_info['duration'] // 60
         duration_sec = video_info['duration'] % 60
 
@@ -602,7 +916,7 @@ async def play(interaction: discord.Interaction, query: str):
 async def show_queue(interaction: discord.Interaction):
     """Show the current playlist"""
     try:
-        items = list(state["queue"]._queue)
+        items = state["queue_items"]
 
         if not items and not state["current_track"]:
             await interaction.response.send_message("📭 Queue is empty")
@@ -614,8 +928,7 @@ async def show_queue(interaction: discord.Interaction):
             response += f"▶️ Now playing: {state['current_track']}\n\n"
 
         if items:
-            for i, url in enumerate(items, 1):
-                response += f"{i}. {url}\n"
+            response += state["queue_display"] + "\n"
 
         await interaction.response.send_message(response)
 
@@ -630,6 +943,10 @@ async def skip(interaction: discord.Interaction):
     try:
         if state["current_track"]:
             state["skip"] = True
+            state["resume_event"].set()
+            # Drops the rest of the track and wakes a producer blocked on a full buffer
+            if state["music_buffer"]:
+                state["music_buffer"].clear()
             await interaction.response.send_message("⏭️ Skipping...")
         else:
             await interaction.response.send_message("❌ Nothing is playing")
@@ -643,20 +960,17 @@ async def skip(interaction: discord.Interaction):
 async def remove(interaction: discord.Interaction, index: int):
     """Remove a track from the queue"""
     try:
-        items = list(state["queue"]._queue)
+        items = state["queue_items"]
 
         if index < 1 or index > len(items):
             await interaction.response.send_message(f"❌ Invalid index. Queue has {len(items)} items")
             return
 
-        removed = items.pop(index - 1)
+        removed = items[index - 1]
+        del items[index - 1]
+        refresh_queue_display()
 
-        # Rebuild queue
-        state["queue"] = asyncio.Queue()
-        for item in items:
-            await state["queue"].put(item)
-
-        save_queue()
+        request_save()
         await interaction.response.send_message(f"🗑️ Removed: {removed}")
 
     except Exception as e:
@@ -701,6 +1015,7 @@ async def resume(interaction: discord.Interaction):
     try:
         if state["paused"]:
             state["paused"] = False
+            state["resume_event"].set()
             await interaction.response.send_message("▶️ Resumed")
         else:
             await interaction.response.send_message("❌ Nothing is paused")
@@ -776,7 +1091,7 @@ async def list_devices(interaction: discord.Interaction):
             await interaction.response.send_message("❌ You are not authorized to view devices", ephemeral=True)
             return
 
-        devices = sd.query_devices()
+        devices = cached_query_devices()
         output_devices = []
 
         for i, device in enumerate(devices):
@@ -816,7 +1131,7 @@ async def set_device(interaction: discord.Interaction, device_id: int):
         await interaction.response.defer(ephemeral=True)
 
         # Validate device ID
-        devices = sd.query_devices()
+        devices = cached_query_devices()
         if device_id < 0 or device_id >= len(devices):
             await interaction.followup.send(f"❌ Invalid device ID. Use `/devices` to see available devices", ephemeral=True)
             return
@@ -835,8 +1150,8 @@ async def set_device(interaction: discord.Interaction, device_id: int):
 
         # Save to selected_device.json
         device_config = {"device_id": device_id, "device_name": device_info.get('name', 'Unknown')}
-        with open("selected_device.json", "w") as f:
-            json.dump(device_config, f, indent=2)
+        DEVICE_FILE.write_bytes(orjson.dumps(device_config, option=orjson.OPT_INDENT_2))
+        _load_device_config.cache_clear()
         logger.info(f"Saved device {device_id} to selected_device.json")
 
         # Restart audio stream
@@ -861,16 +1176,19 @@ async def on_ready():
     """Bot startup"""
     logger.info(f"Logged in as {bot.user}")
 
+    # on_ready fires again after every gateway reconnect - restore and start only once
+    if state["playback_task"]:
+        logger.info("Reconnected - audio system and queue already running")
+        return
+
     # Load saved audio device
-    device_config_path = Path("selected_device.json")
-    if device_config_path.exists():
-        try:
-            with open(device_config_path, 'r') as f:
-                device_config = json.load(f)
-                state["audio_device_id"] = device_config.get("device_id")
-                logger.info(f"Loaded audio device {state['audio_device_id']} from selected_device.json")
-        except Exception as e:
-            logger.warning(f"Failed to load selected_device.json: {e}")
+    try:
+        device_config = _load_device_config()
+        if "device_id" in device_config:
+            state["audio_device_id"] = device_config["device_id"]
+            logger.info(f"Loaded audio device {state['audio_device_id']} from selected_device.json")
+    except Exception as e:
+        logger.warning(f"Failed to load selected_device.json: {e}")
 
     # Sync slash commands
     try:
@@ -888,12 +1206,12 @@ async def on_ready():
 
     # Load saved queue
     saved_items = load_queue()
-    for item in saved_items:
-        await state["queue"].put(item)
+    enqueue(*saved_items)
     logger.info(f"Loaded {len(saved_items)} items from saved queue")
 
     # Start playback loop
     state["playback_task"] = asyncio.create_task(playback_loop())
+    state["save_task"] = asyncio.create_task(queue_saver())
 
     logger.info("Bot is ready!")
 
@@ -901,9 +1219,9 @@ async def on_ready():
 @bot.event
 async def on_command_error(ctx, error):
     """Handle command errors"""
-    if isinstance(error, commands.CommandNotFound):
+    if type(error) is commands.CommandNotFound:
         return
-    elif isinstance(error, commands.MissingRequiredArgument):
+    elif isinstance(error, commands.MissingRequiredArgument):  # Also covers MissingRequiredAttachment
         await ctx.send(f"❌ Missing argument: {error.param.name}")
     else:
         logger.error(f"Command error: {error}")
@@ -918,38 +1236,32 @@ async def shutdown():
     """Graceful shutdown"""
     logger.info("Shutting down...")
 
-    # Stop playback
-    if state["playback_task"]:
-        state["playback_task"].cancel()
+    # Stop playback, prefetch and the background saver together under one timeout
+    tasks = [state["playback_task"], state["save_task"]]
+    if state["prefetch"]:
+        tasks.append(state["prefetch"][1])
+        state["prefetch"] = None
+    tasks = [task for task in tasks if task and not task.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
         try:
-            await asyncio.wait_for(state["playback_task"], timeout=2.0)
-        except (asyncio.CancelledError, asyncio.TimeoutError):
-            pass
-
-    # Stop yt-dlp process
-    if state["yt_task"]:
-        state["yt_task"].terminate()
-        try:
-            await asyncio.wait_for(state["yt_task"].wait(), timeout=1.0)
+            await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), timeout=2.0)
         except asyncio.TimeoutError:
-            state["yt_task"].kill()
-
-    # Stop current track (FFmpeg)
-    if state["music_task"]:
-        state["music_task"].terminate()
-        try:
-            await asyncio.wait_for(state["music_task"].wait(), timeout=1.0)
-        except asyncio.TimeoutError:
-            state["music_task"].kill()
+            logger.warning("Background tasks did not stop within 2s")
 
     # Stop audio system
     stop_audio_system()
 
-    # Save queue
-    save_queue()
+    # Close the ElevenLabs session
+    if state["http"] and not state["http"].closed:
+        await state["http"].close()
 
-    # Close bot
-    await bot.close()
+    # Flush the queue from a worker thread while the gateway connection closes
+    await asyncio.gather(
+        asyncio.to_thread(save_queue, list(state["queue_items"])),
+        bot.close(),
+    )
 
     logger.info("Shutdown complete")
 
@@ -958,6 +1270,23 @@ async def shutdown():
 # Main
 # ============================
 
+async def run_bot():
+    """Run the bot on the current event loop until it is closed"""
+    # Setup signal handlers (Unix only - Windows doesn't support add_signal_handler)
+    if sys.platform != 'win32':
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, lambda: asyncio.create_task(shutdown()))
+
+    async with bot:
+        try:
+            await bot.start(DISCORD_TOKEN)
+        finally:
+            # Covers exits that didn't come through shutdown() (e.g. Ctrl+C on Windows)
+            if not bot.is_closed():
+                await shutdown()
+
+
 def main():
     """Main entry point"""
     # Validate configuration
@@ -968,29 +1297,10 @@ def main():
     if not ELEVENLABS_API_KEY:
         logger.warning("ELEVENLABS_API_KEY not set - TTS will be disabled")
 
-    # Setup signal handlers (Unix only - Windows doesn't support add_signal_handler)
-    if sys.platform != 'win32':
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
-        def signal_handler():
-            asyncio.create_task(shutdown())
-
-        for sig in (signal.SIGTERM, signal.SIGINT):
-            loop.add_signal_handler(sig, signal_handler)
-    else:
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-
     try:
-        # Run bot
-        bot.run(DISCORD_TOKEN)
+        asyncio.run(run_bot())
     except KeyboardInterrupt:
         logger.info("Received interrupt signal")
-    finally:
-        if not loop.is_closed():
-            loop.run_until_complete(shutdown())
-            loop.close()
 
 
 if __name__ == "__main__":
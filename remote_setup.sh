@@ -3,7 +3,11 @@ set -e
 
 echo "[Remote] Installing system dependencies..."
 sudo apt-get update
-sudo apt-get install -y ffmpeg python3-pip
+# PyAV has no armv7l (32-bit Pi OS) wheels, so pip builds it from source there
+# against the system FFmpeg libraries - needs their headers and pkg-config
+sudo apt-get install -y python3-pip python3-dev pkg-config \
+    libavformat-dev libavcodec-dev libavdevice-dev libavutil-dev \
+    libavfilter-dev libswscale-dev libswresample-dev
 
 echo "[Remote] Checking yt-dlp..."
 if ! command -v yt-dlp &> /dev/null; then
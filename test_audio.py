@@ -9,14 +9,87 @@ Usage:
 Examples:
     python test_audio.py        # Use device from selected_device.json or default
     python test_audio.py 5      # Use device 5
+
+Set TEST_AUDIO_48K=1 to run the 48000 Hz test without prompting.
+Set TEST_AUDIO_DURATION=<seconds> to play a longer tone (default 2.0), e.g. for
+soak or latency testing; tones of ~15 minutes or more use the numba oscillator.
 """
 
+import os
 import sys
-import json
+import math
+from functools import lru_cache
 from pathlib import Path
 import numpy as np
+import orjson
 import sounddevice as sd
 
+# Below this many samples np.sin beats the oscillator once numba's ~0.5s import
+# and JIT cache load are counted (~15 minutes of audio at 44.1-48 kHz)
+OSCILLATOR_MIN_SAMPLES = 40_000_000
+
+@lru_cache(maxsize=1)
+def _load_device_config(path="selected_device.json"):
+    """Read and parse selected_device.json once per process"""
+    try:
+        return orjson.loads(Path(path).read_bytes())
+    except FileNotFoundError:
+        return {}
+
+@lru_cache(maxsize=8)
+def _device_info(device):
+    """Query a device once per process (None means the default output device)"""
+    return sd.query_devices(device if device is not None else sd.default.device[1])
+
+def _oscillate(out, omega):
+    """Fill out[n] = sin(omega * n) using the recurrence y[n] = 2cos(omega)y[n-1] - y[n-2]"""
+    c = 2.0 * math.cos(omega)
+    y1 = 0.0
+    y2 = -math.sin(omega)
+    for n in range(out.shape[0]):
+        out[n] = y1
+        y1, y2 = c * y1 - y2, y1
+
+@lru_cache(maxsize=1)
+def _get_oscillator():
+    """Compile _oscillate on first use (one multiply-add per sample), or None without numba"""
+    try:
+        from numba import njit
+    except ImportError:  # numba is optional - np.sin is used instead
+        return None
+    return njit(fastmath=True, cache=True)(_oscillate)
+
+@lru_cache(maxsize=4)
+def _make_tone(sample_rate, duration, frequency):
+    """Build a faded stereo int16 sine once per (rate, duration, frequency); returned read-only"""
+    # Generate sine wave straight into one float32 stereo buffer
+    n = int(sample_rate * duration)
+    stereo_tone = np.empty((n, 2), dtype=np.float32)
+    omega = 2 * np.pi * frequency / sample_rate
+    oscillator = _get_oscillator() if n >= OSCILLATOR_MIN_SAMPLES else None
+    if oscillator is not None:
+        oscillator(stereo_tone[:, 0], omega)
+    else:
+        # float32 phase built in the output column, then sinf in place
+        left = stereo_tone[:, 0]
+        np.multiply(np.arange(n, dtype=np.float32), np.float32(omega), out=left)
+        np.sin(left, out=left)
+    stereo_tone[:, 1] = stereo_tone[:, 0]
+
+    # Apply a 10ms fade in/out to avoid clicks, clamped so the ends never overlap
+    fade_samples = min(int(0.01 * sample_rate), n // 2)
+    if fade_samples:
+        ramp = np.linspace(0, 1, fade_samples, dtype=np.float32)[:, np.newaxis]
+        head, tail = stereo_tone[:fade_samples], stereo_tone[-fade_samples:]
+        np.multiply(head, ramp, out=head)
+        np.multiply(tail, ramp[::-1], out=tail)
+
+    # Quantize once here so PortAudio doesn't convert float -> int16 in its callback
+    np.clip(stereo_tone, -1.0, 1.0, out=stereo_tone)
+    pcm = (stereo_tone * 32767).astype(np.int16)
+    pcm.setflags(write=False)
+    return pcm
+
 def play_test_tone(device=None, duration=2.0, frequency=440.0, sample_rate=44100):
     """
     Play a test tone (A4 = 440 Hz) for the specified duration.
@@ -31,28 +104,14 @@ def play_test_tone(device=None, duration=2.0, frequency=440.0, sample_rate=44100
     print("AUDIO OUTPUT TEST")
     print(f"{'='*60}")
 
-    # Generate sine wave
-    t = np.linspace(0, duration, int(sample_rate * duration), False)
-    tone = np.sin(frequency * 2 * np.pi * t)
-
-    # Create stereo signal
-    stereo_tone = np.column_stack([tone, tone])
-
-    # Apply fade in/out to avoid clicks
-    fade_samples = int(0.01 * sample_rate)  # 10ms fade
-    fade_in = np.linspace(0, 1, fade_samples)
-    fade_out = np.linspace(1, 0, fade_samples)
-    stereo_tone[:fade_samples] *= fade_in[:, np.newaxis]
-    stereo_tone[-fade_samples:] *= fade_out[:, np.newaxis]
+    stereo_tone = _make_tone(sample_rate, duration, frequency)
 
     # Print device info
+    device_info = _device_info(device)
     if device is not None:
-        device_info = sd.query_devices(device)
         print(f"\nUsing device: {device} - {device_info['name']}")
     else:
-        default_device = sd.default.device[1]
-        device_info = sd.query_devices(default_device)
-        print(f"\nUsing default device: {default_device} - {device_info['name']}")
+        print(f"\nUsing default device: {sd.default.device[1]} - {device_info['name']}")
 
     print(f"Sample rate: {sample_rate} Hz")
     print(f"Channels: 2 (stereo)")
@@ -62,8 +121,9 @@ def play_test_tone(device=None, duration=2.0, frequency=440.0, sample_rate=44100
 
     try:
         print("\n🔊 Playing test tone...")
-        sd.play(stereo_tone, sample_rate, device=device)
-        sd.wait()
+        with sd.OutputStream(samplerate=sample_rate, channels=2, device=device,
+                             dtype='int16', blocksize=1024) as stream:
+            stream.write(stereo_tone)
         print("✓ Test tone completed successfully!")
         print("\nIf you heard the tone, audio is working correctly.")
         print("If not, try a different device ID or check your audio settings.")
@@ -82,6 +142,15 @@ def main():
     """Main function"""
     device = None
 
+    # Tone length from the environment
+    try:
+        duration = float(os.environ.get("TEST_AUDIO_DURATION", "2.0"))
+        if duration <= 0:
+            raise ValueError
+    except ValueError:
+        print(f"Error: TEST_AUDIO_DURATION must be a positive number of seconds")
+        sys.exit(1)
+
     # Parse command line arguments
     if len(sys.argv) > 1:
         try:
@@ -93,28 +162,27 @@ def main():
             sys.exit(1)
     else:
         # Try to load device from selected_device.json
-        device_config_path = Path("selected_device.json")
-        if device_config_path.exists():
-            try:
-                with open(device_config_path, 'r') as f:
-                    device_config = json.load(f)
-                    device = device_config.get("device_id")
-                    device_name = device_config.get("device_name", "Unknown")
-                    if device is not None:
-                        print(f"📋 Using device from selected_device.json: {device} - {device_name}")
-            except Exception as e:
-                print(f"⚠️  Failed to load selected_device.json: {e}")
-                print("Using default device instead...")
+        try:
+            device_config = _load_device_config()
+            device = device_config.get("device_id")
+            device_name = device_config.get("device_name", "Unknown")
+            if device is not None:
+                print(f"📋 Using device from selected_device.json: {device} - {device_name}")
+        except Exception as e:
+            print(f"⚠️  Failed to load selected_device.json: {e}")
+            print("Using default device instead...")
 
     # Test with 44100 Hz
     print("\n🧪 Testing with 44100 Hz sample rate...")
-    success_44k = play_test_tone(device=device, sample_rate=44100)
+    success_44k = play_test_tone(device=device, duration=duration, sample_rate=44100)
 
-    # Test with 48000 Hz if Bluetooth
-    if device is not None or input("\n\nTest with 48000 Hz as well? (y/n): ").lower() == 'y':
+    # Test with 48000 Hz if Bluetooth (only prompt when someone is at the terminal)
+    if (device is not None
+            or os.environ.get("TEST_AUDIO_48K") == "1"
+            or (sys.stdin.isatty() and input("\n\nTest with 48000 Hz as well? (y/n): ").lower() == 'y')):
         print("\n🧪 Testing with 48000 Hz sample rate...")
         print("(This often works better with Bluetooth speakers)")
-        success_48k = play_test_tone(device=device, sample_rate=48000)
+        success_48k = play_test_tone(device=device, duration=duration, sample_rate=48000)
 
         if success_48k and not success_44k:
             print("\n💡 TIP: 48000 Hz worked but 44100 Hz didn't!")